@@ -1,28 +1,54 @@
 import os
 import sys
+import atexit
+import hashlib
+import mmap
+import mimetypes
+import posixpath
 import shutil
 import zipfile
 import subprocess
-import xml.etree.ElementTree as ET
+import tempfile
+import threading
+try:
+    # libxml2-backed and API-compatible for everything used here
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+try:
+    # Optional: finds all of a chapter's TOC anchors in a single pass
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 import re
-from urllib.parse import unquote
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import quote, unquote
 
 # Default log file location
 LOG_FILE = os.path.expanduser("~/epub2md.log")
 
+# Opened once, line-buffered, and shared by log() and stderr
+try:
+    _LOG_FH = open(LOG_FILE, "a", encoding="utf-8", buffering=1)
+    atexit.register(_LOG_FH.close)
+except Exception:
+    _LOG_FH = None
+
 def log(message):
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"[EPUB_PY] {message}\n")
-    except Exception:
-        pass
+    if _LOG_FH is not None:
+        try:
+            _LOG_FH.write(f"[EPUB_PY] {message}\n")
+        except Exception:
+            pass
     print(message, flush=True)
 
 # Redirect stderr to log for uncaught exceptions
-try:
-    sys.stderr = open(LOG_FILE, "a", encoding="utf-8")
-except Exception:
-    pass
+if _LOG_FH is not None:
+    sys.stderr = _LOG_FH
 
 # Check for pandoc
 if shutil.which('pandoc') is None:
@@ -40,62 +66,223 @@ if shutil.which('pandoc') is None:
         log("Error: pandoc not found in PATH or common locations.")
         sys.exit(1)
 
+# Patterns used in hot paths (per TOC entry, per line), compiled once
+_SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+_NS_RE = re.compile(r'\{.*\}')
+# A header line: hashes then whitespace on the same line, found anywhere in a chapter
+_HEADER_LINE_RE = re.compile(r'^(#+)[^\S\n]', re.MULTILINE)
+# Markdown ](media/... and HTML src="media/... / src='media/...
+_MEDIA_RE = re.compile(r'''(\]\(|src="|src=')media/''')
+# Footnotes: internal links and the ids they point at
+_MD_LINK_REF_RE = re.compile(r'\]\(#([a-zA-Z0-9_.-]+)\)')
+_HTML_LINK_REF_RE = re.compile(r'href="#([a-zA-Z0-9_.-]+)"')
+_HTML_ID_RE = re.compile(r'id="([a-zA-Z0-9_.-]+)"')
+_ATTR_ID_RE = re.compile(r'\{#([a-zA-Z0-9_.-]+)')
+# Pandoc artifacts removed by cleanup_pandoc_artifacts
+_FOOTNOTE_INLINE_RE = re.compile(r'\^\[(.*?)\]\((.*?)\)\{#([a-zA-Z0-9_.-]+).*?\}\^')
+_LINK_DEF_RE = re.compile(r'\[(.*?)\]\((.*?)\)\{#([a-zA-Z0-9_.-]+).*?\}')
+_IMG_ATTR_RE = re.compile(r'!\[(.*?)\]\((.*?)\)\{.*?\}')
+_SPAN_ATTR_RE = re.compile(r'(?<!\!)\[(.*?)\]\{.*?\}')
+_DIV_RE = re.compile(r'^:::.*?$', re.MULTILINE)
+_HEADER_ATTR_RE = re.compile(r'^(#+.*)\s+\{#[^}]+\}\s*$', re.MULTILINE)
+# \[ \] \" escapes that are unnecessary in Obsidian
+_UNESCAPE_RE = re.compile(r'\\([\[\]"])')
+
 def sanitize_name(name):
     if name is None:
         return "Untitled"
     # Remove invalid characters
-    s = re.sub(r'[\\/*?:"<>|]', "", str(name)).strip()
+    s = _SANITIZE_RE.sub("", str(name)).strip()
     if not s:
         return "Untitled"
     return s[:100]
 
 def get_namespace(element):
-    m = re.match(r'\{.*\}', element.tag)
+    m = _NS_RE.match(element.tag)
     return m.group(0) if m else ''
 
-def parse_ncx(ncx_path):
+def parse_ncx(ncx_file):
+    """
+    Parses the NCX navMap into nested {'title', 'src', 'children'} items.
+    Streams the file with iterparse: each navPoint is turned into an item when it
+    closes and then cleared, so deep or huge TOCs need neither recursion nor the
+    whole tree in memory.
+    """
     try:
-        tree = ET.parse(ncx_path)
-        root = tree.getroot()
-        ns = get_namespace(root)
-        
         toc = []
+        ns = None
+        # One entry per open element: the list its navPoint children go into,
+        # or None when navPoints below it aren't part of the TOC
+        stack = []
+        navmap_seen = False
         
-        def process_navpoint(node):
-            items = []
-            # Find all navPoints (direct children)
-            for child in node:
-                if child.tag.endswith('navPoint'):
-                    # Get Label
-                    navLabel = child.find(f"{ns}navLabel")
-                    text_tag = navLabel.find(f"{ns}text") if navLabel is not None else None
-                    title = text_tag.text if text_tag is not None else "Untitled"
-                    
-                    # Get Content
-                    content = child.find(f"{ns}content")
-                    src = content.attrib.get('src') if content is not None else None
-                    
-                    # Recurse
-                    children = process_navpoint(child)
-                    
-                    items.append({
-                        'title': title,
-                        'src': src,
-                        'children': children
-                    })
-            return items
+        for event, elem in ET.iterparse(ncx_file, events=('start', 'end')):
+            if event == 'start':
+                if not stack:
+                    # Tags built once, then compared exactly
+                    ns = get_namespace(elem)
+                    nav_map = f"{ns}navMap"
+                    nav_point = f"{ns}navPoint"
+                    label_path = f"{ns}navLabel/{ns}text"
+                    content_tag = f"{ns}content"
+                    stack.append(None)
+                elif stack[-1] is not None and elem.tag == nav_point:
+                    stack.append([])
+                elif len(stack) == 1 and elem.tag == nav_map and not navmap_seen:
+                    navmap_seen = True
+                    stack.append(toc)
+                else:
+                    stack.append(None)
+                continue
             
-        navMap = root.find(f"{ns}navMap")
-        if navMap is not None:
-            toc = process_navpoint(navMap)
+            children = stack.pop()
+            if stack and stack[-1] is not None and children is not None:
+                # A finished navPoint: its children were appended as they closed
+                text_tag = elem.find(label_path)
+                content = elem.find(content_tag)
+                stack[-1].append({
+                    'title': text_tag.text if text_tag is not None else "Untitled",
+                    'src': content.attrib.get('src') if content is not None else None,
+                    'children': children
+                })
+                elem.clear()
             
         return toc
     except Exception as e:
         print(f"Error parsing NCX: {e}")
         return []
 
-# Global cache for converted markdown content: src_file -> markdown_text
-MARKDOWN_CACHE = {}
+def local_name(element):
+    # Tag without its {namespace}; comments and processing instructions have none
+    tag = element.tag
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
+
+def first_child(element, *names):
+    for name in names:
+        for child in element:
+            if local_name(child) == name:
+                return child
+    return None
+
+def parse_nav(nav_file):
+    """
+    Parses an EPUB 3 navigation document into the same structure as parse_ncx.
+    """
+    try:
+        if HAVE_LXML:
+            # Tolerate the odd HTML-ism (e.g. undeclared &nbsp;) in the XHTML
+            tree = ET.parse(nav_file, ET.XMLParser(recover=True))
+        else:
+            tree = ET.parse(nav_file)
+        root = tree.getroot()
+        
+        # Tags built once from the document's namespace, then compared exactly
+        ns = get_namespace(root)
+        nav_tag, ol_tag, li_tag = f"{ns}nav", f"{ns}ol", f"{ns}li"
+        label_tags = (f"{ns}a", f"{ns}span")
+        
+        navs = list(root.iter(nav_tag))
+        nav = None
+        for el in navs:
+            epub_type = el.get('{http://www.idpf.org/2007/ops}type') or el.get('epub:type') or ''
+            if 'toc' in epub_type.split():
+                nav = el
+                break
+        if nav is None and navs:
+            nav = navs[0]
+        if nav is None:
+            return []
+        
+        ol = next(nav.iter(ol_tag), None)
+        if ol is None:
+            return []
+        
+        # Iterative walk: each stack entry is an <ol> and the list its items go into
+        toc = []
+        stack = [(ol, toc)]
+        while stack:
+            ol_node, items = stack.pop()
+            for li in ol_node:
+                if li.tag != li_tag:
+                    continue
+                # One pass over the item's children: its label (<a>, else <span>) and sub-list
+                a = span = next_ol = None
+                for child in li:
+                    if child.tag == label_tags[0]:
+                        a = a if a is not None else child
+                    elif child.tag == label_tags[1]:
+                        span = span if span is not None else child
+                    elif child.tag == ol_tag:
+                        next_ol = next_ol if next_ol is not None else child
+                if a is None:
+                    a = span
+                if a is None:
+                    continue
+                children = []
+                if next_ol is not None:
+                    stack.append((next_ol, children))
+                items.append({
+                    'title': ''.join(a.itertext()).strip(),
+                    'src': a.get('href'),
+                    'children': children
+                })
+        
+        return toc
+    except Exception as e:
+        print(f"Error parsing NAV: {e}")
+        return []
+
+# Global cache for converted markdown content: src_file -> markdown_text.
+# Bounded by total size; the least recently used chapters are dropped first
+# (they can be reloaded from the disk cache).
+MARKDOWN_CACHE = OrderedDict()
+MARKDOWN_CACHE_MAX_CHARS = 128 * 1024 * 1024
+_markdown_cache_size = 0
+_markdown_cache_lock = threading.Lock()
+
+# Per source file: line/header index over its markdown, built once on first use
+# and dropped together with the MARKDOWN_CACHE entry
+SECTION_INDEX_CACHE = {}
+# Likewise: every id defined in the chapter -> the line defining it
+FOOTNOTE_INDEX_CACHE = {}
+
+def cache_markdown(src_file, content):
+    global _markdown_cache_size
+    with _markdown_cache_lock:
+        old = MARKDOWN_CACHE.pop(src_file, None)
+        if old is not None:
+            _markdown_cache_size -= len(old)
+        MARKDOWN_CACHE[src_file] = content
+        _markdown_cache_size += len(content)
+        
+        # Always keep the entry just added, however large
+        while _markdown_cache_size > MARKDOWN_CACHE_MAX_CHARS and len(MARKDOWN_CACHE) > 1:
+            evicted, text = MARKDOWN_CACHE.popitem(last=False)
+            _markdown_cache_size -= len(text)
+            SECTION_INDEX_CACHE.pop(evicted, None)
+            FOOTNOTE_INDEX_CACHE.pop(evicted, None)
+
+def release_markdown(src_file):
+    """
+    Drops everything kept for src_file (markdown, indexes, source document and
+    disk cache entry path) once nothing else will slice it.
+    """
+    global _markdown_cache_size
+    with _markdown_cache_lock:
+        text = MARKDOWN_CACHE.pop(src_file, None)
+        if text is not None:
+            _markdown_cache_size -= len(text)
+        SECTION_INDEX_CACHE.pop(src_file, None)
+        FOOTNOTE_INDEX_CACHE.pop(src_file, None)
+        SOURCE_HTML.pop(src_file, None)
+        _CACHE_ENTRY_PATHS.pop(src_file, None)
+
+def get_cached_markdown(src_file):
+    with _markdown_cache_lock:
+        content = MARKDOWN_CACHE.get(src_file)
+        if content is not None:
+            MARKDOWN_CACHE.move_to_end(src_file)
+        return content
 
 def fix_media_links(content, relative_path_to_root):
     """
@@ -106,136 +293,783 @@ def fix_media_links(content, relative_path_to_root):
     if not relative_path_to_root or relative_path_to_root == ".":
         return content
     
+    # Most chapters have no images; a substring test is far cheaper than the regex
+    if 'media/' not in content:
+        return content
+    
     # Ensure we use forward slashes for markdown compatibility
     prefix = relative_path_to_root.replace("\\", "/")
     replacement = f"{prefix}/media/"
     
-    # Regex for Markdown: ![...](media/...)
-    # We look for ](media/
-    content = re.sub(r'\]\(media/', f']({replacement}', content)
+    # One pass for Markdown ![...](media/...) and HTML src="media/..." / src='media/...'
+    return _MEDIA_RE.sub(lambda m: m.group(1) + replacement, content)
+
+# Attributes through which a document pulls in resources (images, SVG, audio/video)
+_RESOURCE_RE = re.compile(rb'''(\b(?:src|xlink:href|poster|data)\s*=\s*["'])([^"'#?]*)''')
+
+# Persistent cache of pandoc output across runs, keyed by the content of the source document
+DISK_CACHE_DIR = os.path.expanduser("~/.cache/epub2md")
+DISK_CACHE_MAX_BYTES = 500 * 1024 * 1024
+# Bump when the pandoc invocation changes so old entries stop matching
+DISK_CACHE_VERSION = b"4"
+
+def source_cache_key(html):
+    # Media references are rewritten to media/... before conversion, so the
+    # document bytes alone determine pandoc's output.
+    return hashlib.sha256(DISK_CACHE_VERSION + html).hexdigest()
+
+# src_file -> its disk cache entry, so each document is hashed once per run
+# rather than on both the lookup and the store
+_CACHE_ENTRY_PATHS = {}
+
+def cache_entry_path(src_file):
+    path = _CACHE_ENTRY_PATHS.get(src_file)
+    if path is None:
+        path = os.path.join(DISK_CACHE_DIR, source_cache_key(SOURCE_HTML[src_file]) + ".md")
+        _CACHE_ENTRY_PATHS[src_file] = path
+    return path
+
+def load_cached_markdown(src_file):
+    """
+    Loads src_file's markdown from the disk cache into MARKDOWN_CACHE.
+    Returns it, or None on a miss.
+    """
+    try:
+        cache_path = cache_entry_path(src_file)
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except OSError:
+        return None
     
-    # Regex for HTML: src="media/..." or src='media/...'
-    content = re.sub(r'src="media/', f'src="{replacement}', content)
-    content = re.sub(r"src='media/", f"src='{replacement}", content)
+    try:
+        # Bump the mtime so eviction drops the least recently used entries;
+        # atime can't be relied on (noatime/relatime mounts)
+        os.utime(cache_path)
+    except OSError:
+        pass
     
+    cache_markdown(src_file, content)
     return content
 
-def get_markdown_content(src_file, root_output_dir, epub_root):
-    # Check cache first
-    if src_file in MARKDOWN_CACHE:
-        return MARKDOWN_CACHE[src_file]
+def store_cached_markdown(src_file, content):
+    try:
+        cache_path = cache_entry_path(src_file)
+        # Written atomically: readers never see a partial entry
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            f = open(tmp_path, 'w', encoding='utf-8')
+        except FileNotFoundError:
+            # Only the very first write has to create the cache directory
+            os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+            f = open(tmp_path, 'w', encoding='utf-8')
+        with f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not write cache entry for {src_file}: {e}")
 
-    full_src_path = os.path.join(epub_root, src_file)
+def evict_disk_cache():
+    """
+    Drops the least recently used cache entries while the cache is over DISK_CACHE_MAX_BYTES.
+    """
+    entries = []
+    total = 0
+    try:
+        for entry in os.scandir(DISK_CACHE_DIR):
+            if entry.name.endswith(".md"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    except OSError:
+        return
     
-    if not os.path.exists(full_src_path):
-        print(f"Warning: Source file not found: {full_src_path}")
-        return ""
+    entries.sort()
+    for _, size, path in entries:
+        if total <= DISK_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
 
-    # Prepare command
-    # We run pandoc from root_output_dir so media is extracted to root_output_dir/media
-    media_dir = "media" 
-    os.makedirs(os.path.join(root_output_dir, media_dir), exist_ok=True)
-    
-    input_dir = os.path.dirname(full_src_path)
-    
+def run_pandoc(html, root_output_dir):
+    # The HTML (bytes) is fed to pandoc on stdin, straight from memory.
+    # Media is copied out of the EPUB beforehand and the documents already point at
+    # media/..., so pandoc doesn't need to fetch or extract anything.
     # We use 'markdown' (Pandoc's default) to preserve Header Attributes like {#id}
     # This allows us to accurately slice content based on TOC anchors.
+    fd, output_path = tempfile.mkstemp(suffix=".md", prefix="epub2md-")
+    os.close(fd)
     cmd = [
         'pandoc',
-        full_src_path,
-        '--extract-media', media_dir,
-        '--resource-path', input_dir,
         '--wrap=none',
-        '-f', 'html',
-        '-t', 'markdown' 
+        # Fixed line endings, so sections can be sliced on '\n' offsets
+        '--eol=lf',
+        # No auto_identifiers on either side: headers keep exactly their own ids.
+        # Otherwise generated ids are deduplicated across the whole input, and
+        # pandoc drops an explicit id equal to the one it would generate, so a
+        # chapter's output would depend on which others share its batch.
+        '-f', 'html-auto_identifiers',
+        '-t', 'markdown-auto_identifiers',
+        # Written to a file rather than a pipe: the markdown is decoded straight from
+        # the mapped file, without a full-size bytes copy next to the str
+        '-o', output_path
     ]
     
     try:
-        # Capture stdout
         # cwd is root_output_dir
-        result = subprocess.run(cmd, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root_output_dir)
+        result = subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                input=html, cwd=root_output_dir)
+        content = ""
+        if result.returncode == 0:
+            with open(output_path, 'rb') as f:
+                # mmap can't map an empty file
+                if os.fstat(f.fileno()).st_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        content = str(mm, 'utf-8')
+        stderr = result.stderr.decode('utf-8', errors='replace')
+        return subprocess.CompletedProcess(cmd, result.returncode, content, stderr)
+    finally:
+        os.remove(output_path)
+
+def get_markdown_content(src_file, root_output_dir):
+    # Check cache first
+    content = get_cached_markdown(src_file)
+    if content is not None:
+        return content
+
+    try:
+        html = SOURCE_HTML[src_file]
+    except KeyError:
+        print(f"Warning: Source file not found: {src_file}")
+        return ""
+
+    content = try_fast_convert(src_file)
+    if content is not None:
+        return content
+
+    content = load_cached_markdown(src_file)
+    if content is not None:
+        return content
+
+    try:
+        result = run_pandoc(html, root_output_dir)
         if result.returncode != 0:
-             print(f"Error converting {src_file}: {result.stderr.decode()}")
+             print(f"Error converting {src_file}: {result.stderr}")
              return ""
         else:
-             stderr_output = result.stderr.decode().strip()
+             stderr_output = result.stderr.strip()
              if stderr_output:
                  print(f"Pandoc warnings for {src_file}:\n{stderr_output}")
              
-             content = result.stdout.decode('utf-8')
-             MARKDOWN_CACHE[src_file] = content
+             content = result.stdout
+             cache_markdown(src_file, content)
+             store_cached_markdown(src_file, content)
              return content
 
     except Exception as e:
         print(f"Exception converting {src_file}: {e}")
         return ""
 
-def extract_section(content, anchor):
+# Small chapters made of plain text, headers, links, images and lists are converted
+# in-process; anything else (or anything whose escaping isn't certain) goes to pandoc.
+# The output matches what pandoc's markdown writer produces for the same document.
+FAST_PATH_MAX_BYTES = 8192
+_FAST_SPACE_RE = re.compile(r'[ \t\n\r\f]+')
+_FAST_SPACES_RE = re.compile(r' {2,}')
+_FAST_BREAK_RE = re.compile(r' *\n *')
+_FAST_UNDERSCORE_RE = re.compile(r'(?<![^\W_])_|_(?![^\W_])')
+_FAST_UNSAFE_RE = re.compile(r'@|!\[|--|\.\.\.|__|[-.][\u2013\u2014\u2026]|[\u2013\u2014\u2026][-.]|^#|#$|#\xa0|\xa0#|\{')
+_FAST_HASH_RE = re.compile(r'(?<= )#(?= )')
+_FAST_BLOCK_START_RE = re.compile(r'^(?:[-+]|\d+[.)])(?= )')
+_FAST_UNSURE_START_RE = re.compile(r'^(?:[A-Za-z]+[.)]|[-+](?! )|\d+[.)](?! |\w)|[(=:~|%#])')
+_FAST_HREF_RE = re.compile(r'^[A-Za-z0-9._~:/?#&=%+-]+$')
+_FAST_CLASS_RE = re.compile(r'^[A-Za-z][\w-]*$')
+_FAST_ESCAPES = str.maketrans({c: '\\' + c for c in '\\*[]`"\'$^~|<>'})
+_FAST_SMART = str.maketrans({'\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'",
+                             '\u2014': '---', '\u2013': '--', '\u2026': '...'})
+_FAST_EMPHASIS = {'em': '*', 'i': '*', 'strong': '**', 'b': '**'}
+_FAST_HEADERS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+
+def fast_escape(text):
+    text = _FAST_SPACE_RE.sub(' ', text)
+    if _FAST_UNSAFE_RE.search(text):
+        raise ValueError("needs pandoc")
+    text = _FAST_UNDERSCORE_RE.sub(r'\\_', text.translate(_FAST_ESCAPES))
+    return _FAST_HASH_RE.sub(r'\\#', text).translate(_FAST_SMART)
+
+def fast_wrap(opening, inner, closing):
+    # Spaces just inside emphasis or link text move outside of it
+    if not inner.strip(' '):
+        raise ValueError("needs pandoc")
+    return ((' ' if inner.startswith(' ') else '') + opening + inner.strip(' ') + closing
+            + (' ' if inner.endswith(' ') else ''))
+
+def fast_inline(element, in_emphasis=False, in_link=False):
+    """
+    Renders element's text and inline children as markdown, with '\n' for line breaks.
+    """
+    pieces = []
+    if element.text:
+        pieces.append(fast_escape(element.text))
+    previous = None
+    for child in element:
+        tag = local_name(child)
+        attrs = set(child.attrib)
+        if tag in _FAST_EMPHASIS:
+            # Nested or back-to-back emphasis gets merged by pandoc
+            if attrs or in_emphasis or (previous in _FAST_EMPHASIS and not pieces[-1]):
+                raise ValueError("needs pandoc")
+            marker = _FAST_EMPHASIS[tag]
+            pieces.append(fast_wrap(marker, fast_inline(child, True, in_link), marker))
+        elif tag == 'a':
+            href = child.get('href', '')
+            if (in_link or attrs != {'href'} or not _FAST_HREF_RE.match(href)
+                    or (pieces and pieces[-1].endswith('!'))):
+                raise ValueError("needs pandoc")
+            inner = fast_inline(child, in_emphasis, True)
+            if inner.strip(' ') == href:
+                raise ValueError("needs pandoc")
+            pieces.append(fast_wrap('[', inner, f"]({href})"))
+        elif tag == 'img':
+            src = child.get('src', '')
+            alt = child.get('alt', '')
+            if (not attrs <= {'src', 'alt'} or len(child) or child.text or not _FAST_HREF_RE.match(src)
+                    or alt != alt.strip() or '#' in alt):
+                raise ValueError("needs pandoc")
+            pieces.append(f"![{fast_escape(alt)}]({src})")
+        elif tag == 'br':
+            if attrs or in_emphasis or in_link:
+                raise ValueError("needs pandoc")
+            pieces.append('\n')
+        else:
+            raise ValueError("needs pandoc")
+        previous = tag
+        pieces.append(fast_escape(child.tail) if child.tail else '')
+    return ''.join(pieces)
+
+def escape_block_start(m):
+    marker = m.group(0)
+    if marker[0].isdigit():
+        return marker[:-1] + '\\' + marker[-1]
+    return '\\' + marker
+
+def fast_line(element, header=False):
+    """
+    Renders one paragraph, list item or header line.
+    """
+    line = fast_inline(element)
+    line = _FAST_BREAK_RE.sub('\n', _FAST_SPACES_RE.sub(' ', line)).strip(' ')
+    if not line or line[0] == '\n' or line[-1] == '\n' or (header and '\n' in line):
+        raise ValueError("needs pandoc")
+    first, *rest = line.split('\n')
+    # Only the very start of a block is escaped; markers after a line break are left alone
+    for part in rest:
+        if _FAST_UNSURE_START_RE.match(part) or _FAST_BLOCK_START_RE.match(part):
+            raise ValueError("needs pandoc")
+    if _FAST_UNSURE_START_RE.match(first) or (header and _FAST_BLOCK_START_RE.match(first)):
+        raise ValueError("needs pandoc")
+    first = _FAST_BLOCK_START_RE.sub(escape_block_start, first)
+    return '\\\n'.join([first] + rest)
+
+def fast_blocks(container, blocks, in_div=False):
+    if (container.text or '').strip():
+        raise ValueError("needs pandoc")
+    for child in container:
+        tag = local_name(child)
+        attrs = set(child.attrib)
+        if (child.tail or '').strip():
+            raise ValueError("needs pandoc")
+        if tag in _FAST_HEADERS:
+            line = fast_line(child, header=True)
+            if attrs - {'id'}:
+                raise ValueError("needs pandoc")
+            header = '#' * _FAST_HEADERS[tag] + ' ' + line
+            identifier = child.get('id')
+            if identifier is not None:
+                # auto_identifiers is off, so pandoc writes every explicit id as is
+                if not identifier or not _FAST_HREF_RE.match(identifier):
+                    raise ValueError("needs pandoc")
+                header += f" {{#{identifier}}}"
+            blocks.append(('header', header))
+        elif tag == 'p':
+            if attrs - {'class'}:
+                raise ValueError("needs pandoc")
+            blocks.append(('p', fast_line(child)))
+        elif tag in ('ul', 'ol'):
+            if attrs or (blocks and blocks[-1][0] == 'list'):
+                raise ValueError("needs pandoc")
+            if (child.text or '').strip() or not len(child):
+                raise ValueError("needs pandoc")
+            items = []
+            for n, item in enumerate(child, 1):
+                if local_name(item) != 'li' or item.attrib or (item.tail or '').strip():
+                    raise ValueError("needs pandoc")
+                line = fast_line(item)
+                if '\\\n' in line:
+                    raise ValueError("needs pandoc")
+                marker = '-' if tag == 'ul' else f"{n}.".ljust(3)
+                items.append(f"{marker} {line}")
+            blocks.append(('list', '\n'.join(items)))
+        elif tag == 'div' and not in_div:
+            cls = child.get('class', '')
+            if attrs != {'class'} or not _FAST_CLASS_RE.match(cls):
+                raise ValueError("needs pandoc")
+            inner = []
+            if any(local_name(c) in _FAST_EMPHASIS or local_name(c) in ('a', 'img', 'br') for c in child):
+                # Inline content straight inside the div becomes a single plain block
+                inner.append(('p', fast_line(child)))
+            else:
+                fast_blocks(child, inner, True)
+            if not inner:
+                raise ValueError("needs pandoc")
+            blocks.append(('div', f"::: {cls}\n" + '\n\n'.join(b for _, b in inner) + "\n:::"))
+        else:
+            raise ValueError("needs pandoc")
+
+def fast_convert(html_bytes):
+    """
+    Converts a small, simple XHTML document without pandoc.
+    Returns the markdown, or None when the document needs the real thing.
+    """
+    try:
+        root = ET.fromstring(html_bytes)
+        body = first_child(root, 'body')
+        if local_name(root) != 'html' or body is None:
+            return None
+        blocks = []
+        fast_blocks(body, blocks)
+    except Exception:
+        return None
+    if not blocks:
+        return None
+    return '\n\n'.join(b for _, b in blocks) + '\n'
+
+def try_fast_convert(src_file):
+    """
+    Converts src_file in-process when it is small and simple enough.
+    Returns the markdown (also put in MARKDOWN_CACHE), or None.
+    """
+    html = SOURCE_HTML.get(src_file)
+    if html is None or len(html) >= FAST_PATH_MAX_BYTES:
+        return None
+    content = fast_convert(html)
+    if content is not None:
+        cache_markdown(src_file, content)
+    return content
+
+# Rare token marking where each source file starts inside a batched pandoc run
+_BATCH_TOKEN = "CD985272F78311"
+_BATCH_MARKER_RE = re.compile(rf'^{_BATCH_TOKEN}-(\d+)$', re.MULTILINE)
+_BODY_RE = re.compile(r'<body[^>]*>(.*)</body>', re.DOTALL | re.IGNORECASE)
+
+def batch_convert(src_files, root_output_dir):
+    """
+    Converts several source files with a single pandoc run.
+    The bodies are concatenated into one HTML document, each preceded by a marker
+    paragraph, which is piped to pandoc; its output is split back apart on those markers.
+    Returns True if every file was converted. If the markers don't all survive,
+    nothing is cached and the caller falls back to converting the files one by one.
+    """
+    try:
+        parts = ["<html><body>\n"]
+        for i, src_file in enumerate(src_files):
+            html = SOURCE_HTML[src_file].decode('utf-8', errors='replace')
+            m = _BODY_RE.search(html)
+            parts.append(f"<p>{_BATCH_TOKEN}-{i}</p>\n")
+            parts.append(m.group(1) if m else html)
+            parts.append("\n")
+        parts.append("</body></html>\n")
+        
+        result = run_pandoc("".join(parts).encode('utf-8'), root_output_dir)
+        if result.returncode != 0:
+            print(f"Error converting batch of {len(src_files)} files: {result.stderr}")
+            return False
+        
+        stderr_output = result.stderr.strip()
+        if stderr_output:
+            print(f"Pandoc warnings for batch of {len(src_files)} files:\n{stderr_output}")
+        
+        # [preamble, index0, text0, index1, text1, ...]
+        chunks = _BATCH_MARKER_RE.split(result.stdout)
+        indices = [int(i) for i in chunks[1::2]]
+        if indices != list(range(len(src_files))):
+            print("Warning: Could not split batched output, converting files one by one.")
+            return False
+        
+        for i, text in zip(indices, chunks[2::2]):
+            # Match the framing of a standalone run: no leading blank lines, one trailing newline
+            text = text.strip('\n')
+            content = text + '\n' if text else ''
+            cache_markdown(src_files[i], content)
+            store_cached_markdown(src_files[i], content)
+        return True
+    
+    except Exception as e:
+        print(f"Exception converting batch of {len(src_files)} files: {e}")
+        return False
+
+def zip_path(base_dir, href):
+    """
+    Resolves an (already URL-decoded) href against a directory inside the EPUB archive.
+    """
+    return posixpath.normpath(posixpath.join(base_dir, href))
+
+def media_name(name, opf_zip_dir):
+    """
+    Path of a media file inside the output's media/ folder: its path relative to the
+    OPF directory, or its full archive path when it lives outside of it.
+    Absolute names and '..' components are flattened away (as zipfile's own
+    extraction does), so the result always stays inside media/.
+    """
+    rel = posixpath.relpath(name, opf_zip_dir or ".")
+    path = name if rel.startswith("../") else rel
+    parts = [part for part in path.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return "/".join(parts)
+
+# Source documents read by extract_sources(): src_file -> HTML bytes with media
+# references rewritten. Conversion works from these; nothing is written to disk.
+SOURCE_HTML = {}
+
+def is_media(name, media_types):
+    media_type = media_types.get(name) or mimetypes.guess_type(name)[0] or ""
+    return media_type.startswith(("image/", "audio/", "video/"))
+
+def advise_willneed(z, names):
+    """
+    Asks the kernel to start reading the given archive members in the background
+    (POSIX_FADV_WILLNEED), so the reads that follow mostly hit the page cache
+    instead of waiting on the disk one member at a time. Best effort: a no-op
+    where posix_fadvise is missing or the archive isn't a real file.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = z.fp.fileno()
+        for name in names:
+            info = z.getinfo(name)
+            # Local header (30 bytes + name + extra field) followed by the data; the
+            # local extra field can differ from the central directory's, hence the slack
+            length = 30 + len(info.filename.encode('utf-8')) + len(info.extra) + info.compress_size + 1024
+            os.posix_fadvise(fd, info.header_offset, length, os.POSIX_FADV_WILLNEED)
+    except (AttributeError, KeyError, OSError, ValueError):
+        pass
+
+def extract_sources(z, src_files, opf_zip_dir, root_output_dir, media_types):
+    """
+    Reads only what conversion needs from the EPUB: the given source documents are
+    kept in memory (SOURCE_HTML) and fed to pandoc on stdin, and the images/audio/video
+    they reference are copied once into root_output_dir/media. References in the
+    documents are rewritten to point at media/..., so pandoc output links there
+    without extracting anything itself. Fonts, stylesheets and anything
+    unreferenced stay in the archive.
+    media_types maps archive paths to manifest media-types.
+    """
+    names = frozenset(z.namelist())
+    # Archive name -> path inside media/, assigned on first reference. Different
+    # members can map to the same path (e.g. OEBPS/Images/a.png and Images/a.png
+    # with the OPF in OEBPS/), so later ones get a numbered name instead.
+    media = {}
+    # Output paths already assigned, lowercased for case-insensitive filesystems
+    taken = set()
+    
+    def output_name(name):
+        if name not in media:
+            rel_name = media_name(name, opf_zip_dir)
+            root, ext = posixpath.splitext(rel_name)
+            n = 1
+            while rel_name and rel_name.lower() in taken:
+                n += 1
+                rel_name = f"{root}-{n}{ext}"
+            taken.add(rel_name.lower())
+            media[name] = rel_name
+        return media[name]
+    
+    # Each output folder is created once, not once per file written into it
+    made_dirs = set()
+    
+    def make_dirs(path):
+        if path not in made_dirs:
+            os.makedirs(path, exist_ok=True)
+            made_dirs.add(path)
+    
+    sources = [(src_file, zip_path(opf_zip_dir, src_file)) for src_file in src_files]
+    sources = [(src_file, name) for src_file, name in sources if name in names]
+    advise_willneed(z, [name for _, name in sources])
+    
+    for src_file, name in sources:
+        base_dir = posixpath.dirname(name)
+        
+        def rewrite(m):
+            ref = unquote(m.group(2).decode('utf-8', errors='replace'))
+            # Leave absolute URLs and data: URIs alone
+            if ':' in ref:
+                return m.group(0)
+            ref_name = zip_path(base_dir, ref)
+            if ref_name not in names or not is_media(ref_name, media_types):
+                return m.group(0)
+            return m.group(1) + b"media/" + quote(output_name(ref_name)).encode()
+        
+        SOURCE_HTML[src_file] = _RESOURCE_RE.sub(rewrite, z.read(name))
+    
+    advise_willneed(z, media)
+    media_dir = os.path.realpath(os.path.join(root_output_dir, "media"))
+    for name, rel_name in media.items():
+        dst = os.path.join(media_dir, rel_name)
+        # Never write outside media/, whatever the archive's member names look like
+        if not rel_name or os.path.commonpath([media_dir, os.path.realpath(dst)]) != media_dir:
+            print(f"Warning: Skipping media outside the output folder: {name}")
+            continue
+        make_dirs(os.path.dirname(dst))
+        with z.open(name) as src, open(dst, 'wb') as f:
+            shutil.copyfileobj(src, f)
+
+def collect_src_files(toc):
+    """
+    Walks the TOC tree and returns the unique source files it references
+    (anchors stripped, URL-decoded), in first-seen order.
+    """
+    src_files = []
+    seen = set()
+
+    # Explicit stack, like plan_toc(); reversed so items come off in document order
+    stack = list(reversed(toc))
+    while stack:
+        item = stack.pop()
+        if item['src']:
+            src_file = unquote(item['src'].split('#')[0])
+            if src_file and src_file not in seen:
+                seen.add(src_file)
+                src_files.append(src_file)
+        stack.extend(reversed(item['children']))
+
+    return src_files
+
+# Smallest share of the book worth its own pandoc process
+BATCH_SHARD_MIN_BYTES = 256 * 1024
+
+def shard_batches(src_files, count):
+    """
+    Splits src_files into at most count batches of similar total size: largest files
+    first, each into the batch that is smallest so far. Small books stay one batch.
+    """
+    sizes = {src_file: len(SOURCE_HTML[src_file]) for src_file in src_files}
+    count = max(1, min(count, len(src_files), sum(sizes.values()) // BATCH_SHARD_MIN_BYTES))
+    shards = [[] for _ in range(count)]
+    loads = [0] * count
+    for src_file in sorted(src_files, key=sizes.get, reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(src_file)
+        loads[i] += sizes[src_file]
+    return shards
+
+def prefetch_markdown(src_files, root_output_dir):
+    """
+    Converts all source files up front, so the TOC walk afterwards only does cache lookups.
+    Files missing from the disk cache go through batched pandoc runs, one per worker
+    on large books since pandoc itself uses a single core; whatever a batch can't
+    handle is converted file by file, with those pandoc processes running in parallel.
+    """
+    # Missing files are left for the TOC walk to report
+    pending = [src_file for src_file in src_files
+               if src_file in SOURCE_HTML
+               and try_fast_convert(src_file) is None
+               and load_cached_markdown(src_file) is None]
+    
+    # Threads are enough here: the workers just wait on pandoc subprocesses.
+    max_workers = min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shards = shard_batches(pending, max_workers) if pending else []
+        converted = executor.map(
+            lambda shard: len(shard) > 1 and batch_convert(shard, root_output_dir), shards)
+        pending = [src_file for shard, ok in zip(shards, list(converted)) if not ok for src_file in shard]
+        
+        futures = [executor.submit(get_markdown_content, src_file, root_output_dir)
+                   for src_file in pending]
+        for future in as_completed(futures):
+            future.result()
+    
+    evict_disk_cache()
+
+def build_section_index(content):
+    """
+    Finds every header in the markdown with one regex scan, recording where
+    each starts and its level. Sections are then sliced by offset, so the
+    chapter is never split into lines.
+    """
+    header_starts = []
+    header_levels = []
+    for m in _HEADER_LINE_RE.finditer(content):
+        header_starts.append(m.start())
+        header_levels.append(len(m.group(1)))
+    
+    return {
+        'header_starts': header_starts,
+        'header_levels': header_levels,
+    }
+
+def anchor_patterns(anchor):
+    return (f"{{#{anchor}}}", f'id="{anchor}"', f"id='{anchor}'", f'name="{anchor}"')
+
+def line_start(content, pos):
+    return content.rfind('\n', 0, pos) + 1
+
+def find_anchor_start(content, anchor):
+    """
+    Returns the offset of the first line containing the anchor as {#id}, id="id",
+    id='id' or name="id", or -1. Uses str.find on the whole chapter rather than
+    testing line by line.
+    """
+    positions = [content.find(pat) for pat in anchor_patterns(anchor)]
+    positions = [pos for pos in positions if pos != -1]
+    if not positions:
+        return -1
+    return line_start(content, min(positions))
+
+def anchor_regex(anchors):
+    """
+    Compiles one alternation matching every anchor_patterns() form of every anchor.
+    Each form captures the anchor in its own group, so m.group(m.lastindex) names it.
+    """
+    # Longest first, so an anchor that prefixes another rarely needs backtracking
+    alts = '|'.join(re.escape(anchor) for anchor in sorted(set(anchors), key=len, reverse=True))
+    return re.compile(rf'''\{{#({alts})\}}|id="({alts})"|id='({alts})'|name="({alts})"''')
+
+def locate_anchors(content, anchors):
+    """
+    Maps each anchor found in the chapter to its find_anchor_start() offset.
+    All of a chapter's anchors are found in one pass over it rather than one
+    str.find pass per anchor and pattern: with pyahocorasick when installed,
+    otherwise with a regex built for this chapter's anchor set.
+    """
+    if len(anchors) < 2:
+        starts = {}
+        for anchor in anchors:
+            start = find_anchor_start(content, anchor)
+            if start != -1:
+                starts[anchor] = start
+        return starts
+    
+    if ahocorasick is None:
+        first = {}
+        wanted = len(set(anchors))
+        for m in anchor_regex(anchors).finditer(content):
+            anchor = m.group(m.lastindex)
+            if anchor not in first:
+                first[anchor] = m.start()
+                if len(first) == wanted:
+                    break
+        return {anchor: line_start(content, pos) for anchor, pos in first.items()}
+    
+    automaton = ahocorasick.Automaton()
+    for anchor in anchors:
+        for pat in anchor_patterns(anchor):
+            automaton.add_word(pat, (anchor, len(pat)))
+    automaton.make_automaton()
+    
+    # Matches come in order of their end offset, so keep the earliest start per anchor
+    first = {}
+    for end, (anchor, length) in automaton.iter(content):
+        pos = end - length + 1
+        if anchor not in first or pos < first[anchor]:
+            first[anchor] = pos
+    return {anchor: line_start(content, pos) for anchor, pos in first.items()}
+
+def get_section_index(src_file, content, anchors=()):
+    """
+    Returns the chapter's build_section_index() result, with 'anchor_starts'
+    mapping all of the chapter's TOC anchors to their line offsets.
+    """
+    index = SECTION_INDEX_CACHE.get(src_file)
+    if index is None:
+        index = build_section_index(content)
+        index['anchor_starts'] = locate_anchors(content, anchors)
+        # Not worth keeping once the chapter itself has been evicted
+        if src_file in MARKDOWN_CACHE:
+            SECTION_INDEX_CACHE[src_file] = index
+    return index
+
+def extract_section(content, anchor, index):
     """
     Extracts a section from markdown content starting at the anchor.
+    index is the content's build_section_index() result.
     """
     if not anchor:
         return content
 
-    lines = content.splitlines()
-    start_idx = -1
-    
-    patterns = [
-        f"{{#{anchor}}}",
-        f'id="{anchor}"',
-        f"id='{anchor}'",
-        f'name="{anchor}"'
-    ]
+    header_starts = index['header_starts']
+    header_levels = index['header_levels']
     
-    for i, line in enumerate(lines):
-        for pat in patterns:
-            if pat in line:
-                start_idx = i
-                break
-        if start_idx != -1:
-            break
+    if anchor in index.get('anchor_starts', {}):
+        start = index['anchor_starts'][anchor]
+    else:
+        start = find_anchor_start(content, anchor)
             
-    if start_idx == -1:
+    if start == -1:
         print(f"Warning: Anchor '{anchor}' not found in content.")
         return content # Fallback
-
-    header_level = 0
     
-    # Check if the start line itself is a header
-    m = re.match(r'^(#+)\s+', lines[start_idx])
-    if m:
-        header_level = len(m.group(1))
+    # First header on or after the start line
+    k = bisect.bisect_left(header_starts, start)
+    
+    # The start line itself is a header, or we look forward (up to 20 lines) for one
+    if k < len(header_starts) and content.count('\n', start, header_starts[k]) < 20:
+        header_level = header_levels[k]
     else:
-        # Look forward for a header
-        for i in range(start_idx, min(start_idx + 20, len(lines))):
-            line = lines[i]
-            m = re.match(r'^(#+)\s+', line)
-            if m:
-                header_level = len(m.group(1))
-                break
-        
-        if header_level == 0:
-            header_level = 2 # Assume level 2 by default
-    
-    # Scan for next header of same or higher level
-    end_idx = len(lines)
-    scan_start = start_idx + 1
-    
-    for i in range(scan_start, len(lines)):
-        line = lines[i]
-        m = re.match(r'^(#+)\s+', line)
-        if m:
-            level = len(m.group(1))
-            if level <= header_level:
-                end_idx = i
-                break
-                
-    return "\n".join(lines[start_idx:end_idx])
+        header_level = 2 # Assume level 2 by default
+    
+    # Scan for next header of same or higher level; the section ends at the newline before it
+    if content.endswith('\n'):
+        end_offset = len(content) - 1
+    else:
+        end_offset = len(content)
+    if k < len(header_starts) and header_starts[k] == start:
+        k += 1
+    
+    for i in range(k, len(header_starts)):
+        if header_levels[i] <= header_level:
+            end_offset = header_starts[i] - 1
+            break
+    
+    # A single slice of the chapter, no split/join round-trip
+    return content[start:end_offset]
+
+def ids_in_line(line):
+    ids = set()
+    # Match HTML id="ID"
+    ids.update(_HTML_ID_RE.findall(line))
+    # Match Pandoc attributes {#ID ...}
+    # We need to be careful not to match just {#}
+    ids.update(_ATTR_ID_RE.findall(line))
+    return ids
+
+def build_footnote_index(full_content):
+    """
+    Maps every id defined in the chapter (id="ID" or {#ID}) to the line defining it.
+    If multiple lines define the same ID (unlikely for valid HTML), the last one wins.
+    """
+    id_index = {}
+    for line in full_content.splitlines():
+        # Optimization: only check if line likely contains an ID
+        if 'id="' in line or '{#' in line:
+            for i in ids_in_line(line):
+                id_index[i] = line
+    return id_index
 
-def append_footnotes(section_content, full_content):
+def get_footnote_index(src_file, full_content):
+    id_index = FOOTNOTE_INDEX_CACHE.get(src_file)
+    if id_index is None:
+        id_index = build_footnote_index(full_content)
+        # Not worth keeping once the chapter itself has been evicted
+        if src_file in MARKDOWN_CACHE:
+            FOOTNOTE_INDEX_CACHE[src_file] = id_index
+    return id_index
+
+def append_footnotes(section_content, id_index):
     """
     Scans section_content for internal links (e.g. (#footnote1)).
-    Finds lines in full_content that define these IDs (e.g. id="footnote1").
+    Looks up the lines defining these IDs in id_index (see build_footnote_index).
     Appends those lines to section_content if they are missing.
     """
     # 1. Find all internal links in section_content
@@ -243,57 +1077,28 @@ def append_footnotes(section_content, full_content):
     
     # Match Markdown links: ](#id)
     # This covers standard markdown links and Pandoc's reference links
-    links = re.findall(r'\]\(#([a-zA-Z0-9_.-]+)\)', section_content)
+    links = _MD_LINK_REF_RE.findall(section_content)
     referenced_ids.update(links)
     
     # Match HTML links: href="#id"
-    html_links = re.findall(r'href="#([a-zA-Z0-9_.-]+)"', section_content)
+    html_links = _HTML_LINK_REF_RE.findall(section_content)
     referenced_ids.update(html_links)
     
     if not referenced_ids:
         return section_content
 
-    # 2. Find definitions in full_content
-    # We look for lines containing id="ID" or {#ID}
-    
-    definitions = {}
-    full_lines = full_content.splitlines()
-    
-    def get_ids_in_line(line):
-        ids = set()
-        # Match HTML id="ID"
-        m_id = re.findall(r'id="([a-zA-Z0-9_.-]+)"', line)
-        ids.update(m_id)
-        # Match Pandoc attributes {#ID ...}
-        # We need to be careful not to match just {#}
-        m_attr = re.findall(r'\{#([a-zA-Z0-9_.-]+)', line)
-        ids.update(m_attr)
-        return ids
-
-    # Scan full content to map IDs to Lines
-    for line in full_lines:
-        # Optimization: only check if line likely contains an ID
-        if 'id="' in line or '{#' in line:
-            ids = get_ids_in_line(line)
-            for i in ids:
-                # Store the line for this ID
-                # If multiple IDs on one line, it's fine.
-                # If multiple lines define same ID (unlikely for valid HTML), last one wins.
-                if i in referenced_ids:
-                    definitions[i] = line
-
-    # 3. Append missing definitions
+    # 2. Append missing definitions
     to_append = []
     
     # Check if definition is already in section_content
     existing_ids_in_section = set()
     for line in section_content.splitlines():
         if 'id="' in line or '{#' in line:
-            existing_ids_in_section.update(get_ids_in_line(line))
+            existing_ids_in_section.update(ids_in_line(line))
         
     for ref_id in referenced_ids:
-        if ref_id not in existing_ids_in_section and ref_id in definitions:
-            line = definitions[ref_id]
+        if ref_id not in existing_ids_in_section and ref_id in id_index:
+            line = id_index[ref_id]
             if line not in to_append:
                 to_append.append(line)
     
@@ -302,188 +1107,249 @@ def append_footnotes(section_content, full_content):
         
     return section_content
 
+def replace_footnote(match):
+    text_content = match.group(1)
+    url = match.group(2)
+    ref_id = match.group(3)
+    # Clean escaped brackets if any
+    clean_text = text_content.replace('\\[', '[').replace('\\]', ']')
+    return f'<sup id="{ref_id}"><a href="{url}">{clean_text}</a></sup>'
+
+def replace_link_def(match):
+    text_content = match.group(1)
+    url = match.group(2)
+    ref_id = match.group(3)
+    clean_text = text_content.replace('\\[', '[').replace('\\]', ']')
+    return f'<a href="{url}" id="{ref_id}">{clean_text}</a>'
+
 def cleanup_pandoc_artifacts(content):
     """
     Cleans up Pandoc's artifacts to make Markdown Obsidian-friendly.
     1. Converts inline ^[text](url){#id}^ to <sup id="id"><a href="#url">text</a></sup>
     2. Converts definition lines [text](url){#id} to <a href="url" id="id">text</a>
-    3. Removes Pandoc Div fences (::: ...)
-    4. Removes Header Attributes ({#id ...})
-    """
-    # Pattern 1: Inline footnotes ^[...](...){...}^
-    pattern1 = r'\^\[(.*?)\]\((.*?)\)\{#([a-zA-Z0-9_.-]+).*?\}\^'
-    
-    def repl1(match):
-        text_content = match.group(1)
-        url = match.group(2)
-        ref_id = match.group(3)
-        # Clean escaped brackets if any
-        clean_text = text_content.replace('\\[', '[').replace('\\]', ']')
-        return f'<sup id="{ref_id}"><a href="{url}">{clean_text}</a></sup>'
-    
-    content = re.sub(pattern1, repl1, content)
-
-    # Pattern 2: Link definitions with attributes [...](...){...}
-    pattern2 = r'\[(.*?)\]\((.*?)\)\{#([a-zA-Z0-9_.-]+).*?\}'
-
-    def repl2(match):
-        text_content = match.group(1)
-        url = match.group(2)
-        ref_id = match.group(3)
-        clean_text = text_content.replace('\\[', '[').replace('\\]', ']')
-        return f'<a href="{url}" id="{ref_id}">{clean_text}</a>'
-
-    content = re.sub(pattern2, repl2, content)
-
-    # Pattern 3: Remove attributes from images ![...](...){...}
-    # Matches: ![alt](url){.class width=...} -> ![alt](url)
-    pattern3 = r'!\[(.*?)\]\((.*?)\)\{.*?\}'
-    content = re.sub(pattern3, r'![\1](\2)', content)
-
-    # Pattern 4: Remove generic span attributes [text]{...}
-    # Matches: [text]{.class} -> text
-    # Note: We use a lookahead to ensure we don't match links [text](url)
-    # But since { immediately follows ], it distinguishes from (url)
-    pattern4 = r'(?<!\!)\[(.*?)\]\{.*?\}'
-    content = re.sub(pattern4, r'\1', content)
-
-    # Pattern 5: Remove Pandoc Divs (::: ...)
-    # Matches lines starting with :::
-    content = re.sub(r'^:::.*?$', '', content, flags=re.MULTILINE)
-
-    # Pattern 6: Remove Header Attributes {#...}
-    # Matches: # Title {#id .class} -> # Title
-    # We look for {#...} at the end of a header line
-    content = re.sub(r'^(#+.*)\s+\{#[^}]+\}\s*$', r'\1', content, flags=re.MULTILINE)
+    3. Removes attributes from images ![alt](url){...} and spans [text]{...}
+    4. Removes Pandoc Div fences (::: ...)
+    5. Removes Header Attributes ({#id ...})
+    """
+    # Each pass is skipped when a substring every one of its matches needs is absent;
+    # str's C search is far cheaper than a regex scan that finds nothing
+    if '){#' in content:
+        content = _FOOTNOTE_INLINE_RE.sub(replace_footnote, content)
+        content = _LINK_DEF_RE.sub(replace_link_def, content)
     
-    # Global cleanup of common Pandoc escapes that are unnecessary in Obsidian
-    content = content.replace(r'\[', '[').replace(r'\]', ']').replace(r'\"', '"')
+    if '{' in content:
+        # ![alt](url){.class width=...} -> ![alt](url)
+        content = _IMG_ATTR_RE.sub(r'![\1](\2)', content)
+        # [text]{.class} -> text; { right after ] tells it apart from a link [text](url)
+        content = _SPAN_ATTR_RE.sub(r'\1', content)
     
-    return content
-
-def convert_toc_item(item, output_base, index, epub_root, root_output_dir):
-    title = item['title']
-    src = item['src']
-    safe_title = sanitize_name(title)
-    prefix = f"{index:02d}"
+    if ':::' in content:
+        content = _DIV_RE.sub('', content)
     
-    has_children = len(item['children']) > 0
+    if '{#' in content:
+        # # Title {#id .class} -> # Title
+        content = _HEADER_ATTR_RE.sub(r'\1', content)
     
-    if has_children:
-        current_dir = os.path.join(output_base, f"{prefix}_{safe_title}")
-        os.makedirs(current_dir, exist_ok=True)
-        filename = f"00_{safe_title}.md"
-        output_path = os.path.join(current_dir, filename)
-    else:
-        current_dir = output_base
-        filename = f"{prefix}_{safe_title}.md"
-        output_path = os.path.join(current_dir, filename)
-
-    if src:
-        if '#' in src:
-            parts = src.split('#')
-            src_file = parts[0]
-            anchor = parts[1]
-        else:
-            src_file = src
-            anchor = None
-            
-        src_file = unquote(src_file)
+    # Global cleanup of common Pandoc escapes that are unnecessary in Obsidian
+    if '\\' not in content:
+        return content
+    return _UNESCAPE_RE.sub(r'\1', content)
+
+
+def plan_toc(toc, root_output_dir):
+    """
+    Walks the TOC tree with an explicit stack, creating the output folders and
+    returning one (output_path, src_file, anchor, rel_path) task per entry that
+    has content, in document order. Arbitrarily deep TOCs can't hit the
+    recursion limit.
+    """
+    tasks = []
+    # (item, folder it goes in, its 1-based position there)
+    stack = [(item, root_output_dir, i+1) for i, item in reversed(list(enumerate(toc)))]
+    while stack:
+        item, output_base, index = stack.pop()
+        title = item['title']
+        src = item['src']
+        safe_title = sanitize_name(title)
+        prefix = f"{index:02d}"
         
-        content = get_markdown_content(src_file, root_output_dir, epub_root)
-            
-        if anchor:
-            final_content = extract_section(content, anchor)
+        has_children = len(item['children']) > 0
+        
+        if has_children:
+            current_dir = os.path.join(output_base, f"{prefix}_{safe_title}")
+            os.makedirs(current_dir, exist_ok=True)
+            filename = f"00_{safe_title}.md"
+            output_path = os.path.join(current_dir, filename)
         else:
-            final_content = content
-            
-        # FIX FOOTNOTES: Append definitions found in full content if referenced in section
-        final_content = append_footnotes(final_content, content)
-            
-        file_dir = os.path.dirname(output_path)
-        rel_path = os.path.relpath(root_output_dir, file_dir)
-        final_content = fix_media_links(final_content, rel_path)
+            current_dir = output_base
+            filename = f"{prefix}_{safe_title}.md"
+            output_path = os.path.join(current_dir, filename)
+
+        if src:
+            if '#' in src:
+                parts = src.split('#')
+                src_file = parts[0]
+                anchor = parts[1]
+            else:
+                src_file = src
+                anchor = None
+                
+            src_file = unquote(src_file)
+            rel_path = os.path.relpath(root_output_dir, current_dir)
+            tasks.append((output_path, src_file, anchor, rel_path))
+
+        # Pushed in reverse so the first child is written next
+        for i in range(len(item['children']) - 1, -1, -1):
+            stack.append((item['children'][i], current_dir, i+1))
+    return tasks
+
+def write_toc_entry(output_path, src_file, anchor, rel_path, root_output_dir, anchors=()):
+    content = get_markdown_content(src_file, root_output_dir)
         
-        # Cleanup Pandoc artifacts (footnotes, divs, headers)
-        final_content = cleanup_pandoc_artifacts(final_content)
-            
-        if final_content.strip():
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(final_content)
+    if anchor:
+        index = get_section_index(src_file, content, anchors)
+        final_content = extract_section(content, anchor, index)
+    else:
+        final_content = content
+        
+    # FIX FOOTNOTES: Append definitions found in full content if referenced in section
+    final_content = append_footnotes(final_content, get_footnote_index(src_file, content))
+        
+    final_content = fix_media_links(final_content, rel_path)
+    
+    # Cleanup Pandoc artifacts (footnotes, divs, headers)
+    final_content = cleanup_pandoc_artifacts(final_content)
+        
+    if final_content.strip():
+        # Encoded once and moved into place, so an interrupted run never leaves a truncated chapter
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(final_content.encode('utf-8'))
+        os.replace(tmp_path, output_path)
+
+# Below this many TOC entries, starting worker processes costs more than it saves
+PROCESS_POOL_MIN_TASKS = 64
+
+def write_toc_entries(tasks, root_output_dir, content=None, html=None):
+    """
+    Writes all TOC entries sliced from one source file. The group holds every
+    entry that reads the file, so its markdown is released once they are written.
+    In a worker process, the chapter comes along with the group: its markdown
+    as content, or, if it isn't converted, its source document as html.
+    """
+    src_file = tasks[0][1]
+    if html is not None:
+        SOURCE_HTML[src_file] = html
+    if content is not None:
+        cache_markdown(src_file, content)
+    
+    anchors = [anchor for _, _, anchor, _ in tasks if anchor]
+    for task in tasks:
+        write_toc_entry(*task, root_output_dir, anchors)
+    release_markdown(src_file)
 
-    if has_children:
-        for i, child in enumerate(item['children']):
-            convert_toc_item(child, current_dir, i+1, epub_root, root_output_dir)
+def convert_toc(toc, root_output_dir):
+    """
+    Writes one markdown file per TOC entry. The tree is flattened into independent
+    tasks first (all folders created up front), then the tasks run in parallel,
+    grouped by source file so each chapter is indexed by a single worker.
+    """
+    tasks = plan_toc(toc, root_output_dir)
+    
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task[1], []).append(task)
+    
+    if len(tasks) < PROCESS_POOL_MIN_TASKS:
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(write_toc_entries, group, root_output_dir)
+                       for group in groups.values()]
+            for future in as_completed(futures):
+                future.result()
+        return
+    
+    # Slicing and cleanup are pure Python and hold the GIL, so large books use
+    # processes. Each group is sent with exactly the one chapter it slices, so a
+    # worker never depends on what it was seeded with (workers may be spawned
+    # fresh) and no markdown is sent back. The parent drops a chapter once its
+    # group is written.
+    with ProcessPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        futures = {}
+        for src_file, group in groups.items():
+            content = get_cached_markdown(src_file)
+            html = SOURCE_HTML.get(src_file) if content is None else None
+            future = executor.submit(write_toc_entries, group, root_output_dir, content, html)
+            futures[future] = src_file
+        for future in as_completed(futures):
+            future.result()
+            release_markdown(futures[future])
 
 def main(epub_path):
     if not os.path.exists(epub_path):
         print(f"File not found: {epub_path}")
         return
 
-    temp_dir = os.path.join(os.path.dirname(os.path.abspath(epub_path)), "temp_epub_extract")
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-        
     print(f"Processing: {epub_path}")
     try:
-        with zipfile.ZipFile(epub_path, 'r') as z:
-            z.extractall(temp_dir)
+        # Kept open for the whole run: metadata and source documents are read
+        # straight from the archive; only referenced media is written out.
+        z = zipfile.ZipFile(epub_path, 'r')
     except zipfile.BadZipFile:
         print("Error: Invalid EPUB file.")
         return
         
-    container = os.path.join(temp_dir, "META-INF", "container.xml")
-    if not os.path.exists(container):
-        print("Invalid EPUB: META-INF/container.xml missing")
-        return
-        
     try:
-        tree = ET.parse(container)
-        root = tree.getroot()
+        try:
+            container = z.read("META-INF/container.xml")
+        except KeyError:
+            print("Invalid EPUB: META-INF/container.xml missing")
+            return
+        
+        root = ET.fromstring(container)
         rootfile = None
-        for child in root.iter():
-            if 'full-path' in child.attrib:
-                rootfile = child.attrib['full-path']
-                break
+        rootfile_el = root.find('.//*[@full-path]')
+        if rootfile_el is not None:
+            rootfile = rootfile_el.get('full-path')
                 
         if not rootfile:
             print("Could not find OPF path")
             return
             
-        opf_path = os.path.join(temp_dir, rootfile)
-        opf_dir = os.path.dirname(opf_path)
+        opf_zip_dir = posixpath.dirname(rootfile)
         
-        opf_tree = ET.parse(opf_path)
-        opf_root = opf_tree.getroot()
+        opf_root = ET.fromstring(z.read(rootfile))
         opf_ns = get_namespace(opf_root)
         
+        # One pass over the manifest: archive path -> media-type (to pick out the
+        # media to copy), id -> href (TOC and spine lookups) and the nav document
+        media_types = {}
+        id_to_href = {}
+        nav_href = None
+        manifest = opf_root.find(f"{opf_ns}manifest")
+        if manifest is not None:
+            for item in manifest.findall(f"{opf_ns}item"):
+                attrib = item.attrib
+                href = attrib.get('href')
+                iid = attrib.get('id')
+                if iid:
+                    id_to_href.setdefault(iid, href)
+                if href:
+                    media_types[zip_path(opf_zip_dir, unquote(href))] = attrib.get('media-type', '')
+                if nav_href is None and 'nav' in attrib.get('properties', '').split():
+                    nav_href = href
+        
         spine = opf_root.find(f"{opf_ns}spine")
         toc_id = spine.attrib.get('toc') if spine is not None else None
         
-        toc_file = None
-        
-        if toc_id:
-            manifest = opf_root.find(f"{opf_ns}manifest")
-            if manifest is not None:
-                for item in manifest.findall(f"{opf_ns}item"):
-                    if item.attrib.get('id') == toc_id:
-                        toc_file = item.attrib.get('href')
-                        break
-                        
+        toc_file = id_to_href.get(toc_id) if toc_id else None
         if not toc_file:
-             manifest = opf_root.find(f"{opf_ns}manifest")
-             if manifest is not None:
-                 for item in manifest.findall(f"{opf_ns}item"):
-                     props = item.attrib.get('properties', '')
-                     if 'nav' in props.split():
-                         toc_file = item.attrib.get('href')
-                         break
+            toc_file = nav_href
                          
         if not toc_file:
             print("Could not find TOC file in OPF.")
             return
             
-        toc_full_path = os.path.join(opf_dir, toc_file)
+        toc_zip_path = zip_path(opf_zip_dir, unquote(toc_file))
         
         output_dir = os.path.splitext(epub_path)[0] + "_toc_split"
         if os.path.exists(output_dir):
@@ -491,65 +1357,39 @@ def main(epub_path):
         os.makedirs(output_dir)
         
         toc_structure = []
-        if toc_file.lower().endswith('.ncx'):
-            toc_structure = parse_ncx(toc_full_path)
+        # Parsed straight from the archive member
+        try:
+            toc_fh = z.open(toc_zip_path)
+        except KeyError:
+            # Listed in the OPF but not in the archive: fall back to the spine below
+            print(f"Error parsing TOC: {toc_zip_path} not found in EPUB")
         else:
-            try:
-                from bs4 import BeautifulSoup
-                with open(toc_full_path, 'r', encoding='utf-8') as f:
-                    soup = BeautifulSoup(f, 'html.parser')
-                
-                nav = soup.find('nav', attrs={'epub:type': 'toc'}) or soup.find('nav')
-                if nav:
-                    def process_ol(ol_node):
-                        items = []
-                        for li in ol_node.find_all('li', recursive=False):
-                            a = li.find('a', recursive=False) or li.find('span', recursive=False)
-                            if a:
-                                title = a.get_text().strip()
-                                href = a.get('href')
-                                children = []
-                                next_ol = li.find('ol', recursive=False)
-                                if next_ol:
-                                    children = process_ol(next_ol)
-                                items.append({'title': title, 'src': href, 'children': children})
-                        return items
-    
-                    ol = nav.find('ol')
-                    if ol:
-                        toc_structure = process_ol(ol)
-            except ImportError:
-                print("BeautifulSoup not found, cannot parse EPUB 3 Nav.")
-            except Exception as e:
-                print(f"Error parsing NAV: {e}")
+            with toc_fh:
+                if toc_file.lower().endswith('.ncx'):
+                    toc_structure = parse_ncx(toc_fh)
+                else:
+                    toc_structure = parse_nav(toc_fh)
 
         if toc_structure:
-            for i, item in enumerate(toc_structure):
-                convert_toc_item(item, output_dir, i+1, opf_dir, output_dir)
+            src_files = collect_src_files(toc_structure)
+            extract_sources(z, src_files, opf_zip_dir, output_dir, media_types)
+            prefetch_markdown(src_files, output_dir)
+            convert_toc(toc_structure, output_dir)
             print(f"Success! Output directory: {output_dir}")
         else:
             print("No TOC structure found in NCX/Nav. Falling back to Spine (linear structure)...")
-            manifest = opf_root.find(f"{opf_ns}manifest")
-            id_to_href = {}
-            if manifest is not None:
-                for item in manifest.findall(f"{opf_ns}item"):
-                    iid = item.attrib.get('id')
-                    href = item.attrib.get('href')
-                    if iid and href:
-                        id_to_href[iid] = href
-            
-            spine = opf_root.find(f"{opf_ns}spine")
             if spine is not None:
                 spine_items = []
                 for itemref in spine.findall(f"{opf_ns}itemref"):
-                    idref = itemref.attrib.get('idref')
-                    if idref and idref in id_to_href:
-                        href = id_to_href[idref]
+                    href = id_to_href.get(itemref.attrib.get('idref'))
+                    if href:
                         spine_items.append({'title': f"Section {len(spine_items)+1}", 'src': href, 'children': []})
                 
                 if spine_items:
-                    for i, item in enumerate(spine_items):
-                        convert_toc_item(item, output_dir, i+1, opf_dir, output_dir)
+                    src_files = collect_src_files(spine_items)
+                    extract_sources(z, src_files, opf_zip_dir, output_dir, media_types)
+                    prefetch_markdown(src_files, output_dir)
+                    convert_toc(spine_items, output_dir)
                     print(f"Success! Output directory: {output_dir}")
                 else:
                     print("Error: No Spine items found.")
@@ -557,8 +1397,7 @@ def main(epub_path):
                  print("Error: No Spine found.")
 
     finally:
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        z.close()
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -2,12 +2,38 @@ import os
 import re
 import sys
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Code fence lines and header lines in one alternation: a match with no title
+# is a fence opening or closing a code block, one with a title a header candidate
+_H1_SPLIT_RE = re.compile(r'^(?:[^\S\n]*(?:```|~~~)|#[^\S\n]+(.+)$)', re.MULTILINE)
+_H2_SPLIT_RE = re.compile(r'^(?:[^\S\n]*(?:```|~~~)|##[^\S\n]+(.+)$)', re.MULTILINE)
+_H2_START_RE = re.compile(r'^##[^\S\n]', re.MULTILINE)
 
 def sanitize_filename(name):
     # Remove invalid characters and strip whitespace
     s = re.sub(r'[\/*?:"<>|]', "", name).strip()
     return s[:100] # Limit length
 
+def find_headers(content, pattern, start=0, end=None):
+    """
+    Returns (offset, title) for each header matched by pattern in content[start:end],
+    skipping any inside fenced code blocks. A single scan: only fence and header
+    lines are visited, toggling the code block state as fences go by.
+    start must not be inside a code block.
+    """
+    if end is None:
+        end = len(content)
+    headers = []
+    in_code = False
+    for m in pattern.finditer(content, start, end):
+        title = m.group(1)
+        if title is None:
+            in_code = not in_code
+        elif not in_code:
+            headers.append((m.start(), title))
+    return headers
+
 def split_markdown(file_path):
     if not os.path.exists(file_path):
         print(f"File not found: {file_path}")
@@ -19,111 +45,64 @@ def split_markdown(file_path):
     base_dir = os.path.dirname(file_path)
     filename = os.path.basename(file_path)
     file_root, _ = os.path.splitext(filename)
-    
+
     output_dir = os.path.join(base_dir, f"{file_root}_split")
     if os.path.exists(output_dir):
         shutil.rmtree(output_dir)
     os.makedirs(output_dir)
 
-    lines = content.splitlines()
-    
-    chunks = []
-    current_chunk = {'type': 'preamble', 'lines': []}
-    chunks.append(current_chunk)
-    
-    in_code_block = False
-    
-    for line in lines:
-        stripped = line.lstrip()
-        if stripped.startswith("```") or stripped.startswith("~~~"):
-            in_code_block = not in_code_block
-            current_chunk['lines'].append(line)
-            continue
-            
-        if in_code_block:
-            current_chunk['lines'].append(line)
-            continue
+    # Chunks are (start, end, title) offsets into content, sliced only when written
+    starts = [(0, None)] + find_headers(content, _H1_SPLIT_RE)
+    ends = [start for start, _ in starts[1:]] + [len(content)]
+    chunks = [(start, end, title) for (start, title), end in zip(starts, ends)]
 
-        # Check for H1
-        m = re.match(r'^#\s+(.+)$', line)
-        if m:
-            title = m.group(1)
-            current_chunk = {'type': 'h1', 'title': title, 'lines': [line]}
-            chunks.append(current_chunk)
-        else:
-            current_chunk['lines'].append(line)
+    # (path, start, end) of every file to write; folders are created while planning
+    # and the files written afterwards by a thread pool, since writing is I/O bound
+    writes = []
 
-    for i, chunk in enumerate(chunks):
-        if not chunk['lines']:
+    for i, (start, end, h1_title) in enumerate(chunks):
+        if i == 0:
+            writes.append((os.path.join(output_dir, "00_Preamble.md"), start, end))
             continue
-            
-        if chunk['type'] == 'preamble':
-            text = "
-".join(chunk['lines']).strip()
-            if text:
-                with open(os.path.join(output_dir, "00_Preamble.md"), "w", encoding="utf-8") as f:
-                    f.write(text)
-            continue
-            
-        h1_title = chunk['title']
-        h1_lines = chunk['lines']
-        
-        has_h2 = any(re.match(r'^##\s+', l) for l in h1_lines)
-        
+
+        has_h2 = _H2_START_RE.search(content, start, end) is not None
+
         safe_h1_title = sanitize_filename(h1_title)
         prefix = f"{i:02d}"
-        
+
         if has_h2:
             folder_name = f"{prefix}_{safe_h1_title}"
             folder_path = os.path.join(output_dir, folder_name)
             os.makedirs(folder_path)
-            
-            sub_chunks = []
-            curr_sub = {'type': 'intro', 'lines': []}
-            sub_chunks.append(curr_sub)
-            
-            in_code_block_h2 = False
-            
-            for line in h1_lines:
-                stripped = line.lstrip()
-                if stripped.startswith("```") or stripped.startswith("~~~"):
-                    in_code_block_h2 = not in_code_block_h2
-                    curr_sub['lines'].append(line)
-                    continue
-                
-                if in_code_block_h2:
-                    curr_sub['lines'].append(line)
-                    continue
-
-                m2 = re.match(r'^##\s+(.+)$', line)
-                if m2:
-                    sub_title = m2.group(1)
-                    curr_sub = {'type': 'h2', 'title': sub_title, 'lines': [line]}
-                    sub_chunks.append(curr_sub)
-                else:
-                    curr_sub['lines'].append(line)
-            
-            for j, sub in enumerate(sub_chunks):
-                text = "
-".join(sub['lines']).strip()
-                if not text:
-                    continue
-                
-                if sub['type'] == 'intro':
+
+            # H1s are only found outside code blocks, so neither is the start of its region
+            sub_starts = [(start, None)] + find_headers(content, _H2_SPLIT_RE, start, end)
+            sub_ends = [sub_start for sub_start, _ in sub_starts[1:]] + [end]
+
+            for j, ((sub_start, sub_title), sub_end) in enumerate(zip(sub_starts, sub_ends)):
+                if sub_title is None:
                     fname = "00_Overview.md"
                 else:
-                    safe_h2 = sanitize_filename(sub['title'])
+                    safe_h2 = sanitize_filename(sub_title)
                     fname = f"{j:02d}_{safe_h2}.md"
-                
-                with open(os.path.join(folder_path, fname), "w", encoding="utf-8") as f:
-                    f.write(text)
+
+                writes.append((os.path.join(folder_path, fname), sub_start, sub_end))
         else:
             fname = f"{prefix}_{safe_h1_title}.md"
-            text = "
-".join(h1_lines).strip()
-            with open(os.path.join(output_dir, fname), "w", encoding="utf-8") as f:
+            writes.append((os.path.join(output_dir, fname), start, end))
+
+    def write_chunk(path, start, end):
+        # Sliced here, so only the chunks being written are held as copies
+        text = content[start:end].strip()
+        # Empty chunks are skipped; an H1 chunk always has its header line
+        if text:
+            with open(path, "w", encoding="utf-8") as f:
                 f.write(text)
 
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        # list() so an error in any write is raised here
+        list(executor.map(lambda w: write_chunk(*w), writes))
+
     print(f"Successfully processed {file_path}")
     print(f"Output directory: {output_dir}")
 